@@ -6,147 +6,338 @@ import os
 import shutil
 import threading
 import tempfile
-import subprocess
+import glob
+import time
+import queue
+import contextlib
+import functools
 import re
+import stat
+import posixpath
+import tarfile
+import zipfile
 import paramiko
 from paramiko import SSHClient
-from scp import SCPClient
 from tqdm import tqdm
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 import argparse
 import frida
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def read_js_file(filename):
+    """Read a JavaScript source file."""
+    with open(filename, 'r', encoding='utf-8') as f:
+        return f.read()
+
+
 # Constants
 USER = 'root'
 PASSWORD = 'alpine'
 HOSTNAME = 'localhost'
 PORT = 2222
 KEY_FILENAME = None
+SFTP_WINDOW_SIZE = 16 << 20
+TRANSFER_WORKERS = 6
+FAST_CIPHERS = ('aes128-gcm@openssh.com', 'aes128-ctr')
 
 SCRIPT_DIR = os.path.dirname(os.path.realpath(__file__))
 DUMP_JS = os.path.join(SCRIPT_DIR, 'dump.js')
+DUMP_JS_SOURCE = read_js_file(DUMP_JS)
 TEMP_DIR = tempfile.gettempdir()
 PAYLOAD_DIR = 'Payload'
 PAYLOAD_PATH = os.path.join(TEMP_DIR, PAYLOAD_DIR)
 FILE_DICT = {}
+DEVICE_TYPE = 'usb' if int(frida.__version__.partition('.')[0]) >= 12 else 'tether'
+PACKAGE_QUEUE = queue.Queue()
 
 FINISHED = threading.Event()
+DUMP_FAILED = threading.Event()
+DEVICE_READY = threading.Event()
 
 
 def get_usb_iphone():
     """Detect USB iPhone using Frida."""
     device_manager = frida.get_device_manager()
-    device = None
-    device_type = 'usb' if int(frida.__version__.split('.')[0]) >= 12 else 'tether'
-    
-    while device is None:
-        devices = [dev for dev in device_manager.enumerate_devices() if dev.type == device_type]
-        if not devices:
-            print('Waiting for USB device...')
-            FINISHED.wait()
-        else:
-            device = devices[0]
-    
-    return device
 
+    def on_added(device):
+        if device.type == DEVICE_TYPE:
+            DEVICE_READY.set()
 
-def generate_ipa(path, display_name):
-    """Generate IPA from the dumped app."""
-    ipa_filename = f'{display_name}.ipa'
-    print(f'Generating "{ipa_filename}"')
-    
+    device_manager.on('added', on_added)
     try:
-        app_name = FILE_DICT['app']
-        
-        for key, value in FILE_DICT.items():
-            src = os.path.join(path, key)
-            dest = os.path.join(path, app_name, value)
-            if key != 'app':
-                shutil.move(src, dest)
-        
-        zip_args = ('zip', '-qr', os.path.join(os.getcwd(), ipa_filename), PAYLOAD_DIR)
-        subprocess.check_call(zip_args, cwd=TEMP_DIR)
-        shutil.rmtree(PAYLOAD_PATH)
-    except Exception as e:
-        print(f"Error generating IPA: {e}")
-        FINISHED.set()
+        waiting = False
+        while True:
+            DEVICE_READY.clear()
+            device = next((dev for dev in device_manager.enumerate_devices() if dev.type == DEVICE_TYPE), None)
+            if device is not None:
+                break
+            if not waiting:
+                print('Waiting for USB device...')
+                waiting = True
+            DEVICE_READY.wait(timeout=1.0)
+    finally:
+        device_manager.off('added', on_added)
+    
+    return device
 
 
-def on_message(message, data):
-    """Handle messages received from Frida script."""
-    t = tqdm(unit='B', unit_scale=True, unit_divisor=1024, miniters=1)
-    last_sent = [0]
-
-    def progress(filename, size, sent):
-        base_name = os.path.basename(filename)
-        t.desc = base_name
-        t.total = size
-        t.update(sent - last_sent[0])
-        last_sent[0] = 0 if size == sent else sent
-
-    if 'payload' in message:
-        payload = message['payload']
-        if 'dump' in payload:
-            scp_transfer(payload['dump'], PAYLOAD_PATH)
-            FILE_DICT[os.path.basename(payload['dump'])] = extract_path(payload['path'])
-        
-        if 'app' in payload:
-            scp_transfer(payload['app'], PAYLOAD_PATH, recursive=True)
-            FILE_DICT['app'] = os.path.basename(payload['app'])
-        
-        if 'done' in payload:
-            FINISHED.set()
-    
-    t.close()
+@contextlib.contextmanager
+def open_ipa(ipa_path, compress):
+    """Open the output archive and yield a function that adds (path, arcname) to it."""
+    if compress == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=3, threads=-1)
+        with open(ipa_path, 'wb') as fp, \
+                compressor.stream_writer(fp, closefd=False) as writer, \
+                tarfile.open(fileobj=writer, mode='w|') as tar:
+            yield lambda src, arcname: tar.add(src, arcname=arcname, recursive=False)
+    else:
+        compression = zipfile.ZIP_DEFLATED if compress == 'deflate' else zipfile.ZIP_STORED
+        with zipfile.ZipFile(ipa_path, 'w', compression=compression, allowZip64=True) as ipa:
+            yield ipa.write
+
 
+def generate_ipa(display_name, compress='store'):
+    """Generate IPA from files queued on PACKAGE_QUEUE until the None sentinel arrives.
 
-def scp_transfer(src, dest, recursive=False):
-    """Transfer files via SCP."""
+    Returns True on success. On failure the partial archive is removed and the
+    queue is still drained, so transfers never block on a dead packager.
+    """
+    ipa_filename = f'{display_name}.tar.zst' if compress == 'zstd' else f'{display_name}.ipa'
+    ipa_path = os.path.join(os.getcwd(), ipa_filename)
+    tqdm.write(f'Generating "{ipa_filename}"')
+    
+    items = iter(PACKAGE_QUEUE.get, None)
+    success = False
     try:
-        print(f"Transferring {src} to {dest} via SCP")
-        with SCPClient(ssh.get_transport(), progress=progress_bar, socket_timeout=60) as scp:
-            scp.get(src, dest, recursive=recursive)
-
-        # Check if the file exists before attempting to chmod
-        base_name = os.path.basename(src).decode('utf-8') if isinstance(src, bytes) else src
-        dest_path = os.path.join(dest, base_name)
-
-        if os.path.exists(dest_path):
-            print(f"Changing permissions for {dest_path}")
-            chmod_args = ('chmod', '755', dest_path)
-            subprocess.check_call(chmod_args)
-    except subprocess.CalledProcessError as err:
-        print(f"Error setting file permissions: {err}")
+        with open_ipa(ipa_path, compress) as add:
+            for src, arcname in items:
+                add(src, arcname)
+        success = not DUMP_FAILED.is_set()
+        if not success:
+            tqdm.write(f'Some files were not transferred, discarding "{ipa_filename}"')
     except Exception as e:
-        print(f"Error during SCP transfer: {e}")
+        tqdm.write(f"Error generating IPA: {e}")
+        for _ in items:
+            pass
+    finally:
+        shutil.rmtree(PAYLOAD_PATH, ignore_errors=True)
+
+    if not success and os.path.exists(ipa_path):
+        os.remove(ipa_path)
+    return success
+
+
+def _handle_dump(payload, progress):
+    """Pull a decrypted module and remember where it belongs in the bundle."""
+    remote_path = payload['dump']
+    if scp_transfer(sftp, remote_path, PAYLOAD_PATH, progress):
+        FILE_DICT[posixpath.basename(remote_path)] = extract_path(payload['path'])
+
+
+def _handle_app(payload, progress):
+    """Queue the decrypted modules, then pull the rest of the app bundle."""
+    app_name = FILE_DICT['app'] = posixpath.basename(payload['app'])
+    dumped = set()
+    for key, value in FILE_DICT.items():
+        if key != 'app':
+            dumped.add(value)
+            PACKAGE_QUEUE.put((os.path.join(PAYLOAD_PATH, key), f'{PAYLOAD_DIR}/{app_name}/{value}'))
+    scp_transfer(sftp, payload['app'], PAYLOAD_PATH, progress, skip=dumped,
+                 on_file=lambda local_path, rel_path:
+                 PACKAGE_QUEUE.put((local_path, f'{PAYLOAD_DIR}/{rel_path}')))
+
+
+def _handle_done(payload, progress):
+    """Close the packaging queue and release start_dump."""
+    PACKAGE_QUEUE.put(None)
+    FINISHED.set()
 
 
+_HANDLERS = {
+    'dump': _handle_dump,
+    'app': _handle_app,
+    'done': _handle_done,
+}
 
 
-def progress_bar(filename, size, sent):
-    """Display progress for SCP transfer."""
-    base_name = os.path.basename(filename.decode('utf-8') if isinstance(filename, bytes) else filename)
-    t = tqdm(unit='B', unit_scale=True, unit_divisor=1024, miniters=1)
-    t.desc = base_name
-    t.total = size
-    t.update(sent)
+def on_message(progress, message, data):
+    """Handle messages received from Frida script."""
+    payload = message.get('payload')
+    if payload:
+        for key in payload:
+            handler = _HANDLERS.get(key)
+            if handler is not None:
+                handler(payload, progress)
+
+
+def _open_sftp():
+    """Open an SFTP channel on the shared SSH transport."""
+    return paramiko.SFTPClient.from_transport(ssh.get_transport(), window_size=SFTP_WINDOW_SIZE)
+
+
+def _list_remote(sftp, root):
+    """List everything under a remote directory as (path, is_dir) pairs.
+
+    Symlinks are followed like scp -r does; a dangling or looping link raises.
+    """
+    entries = []
+    pending = [(root, frozenset([sftp.normalize(root)]))]
+    while pending:
+        remote_dir, ancestors = pending.pop()
+        for attr in sftp.listdir_attr(remote_dir):
+            remote_path = posixpath.join(remote_dir, attr.filename)
+            mode = attr.st_mode
+            target = None
+            if stat.S_ISLNK(mode):
+                mode = sftp.stat(remote_path).st_mode
+                target = sftp.normalize(remote_path)
+            is_dir = stat.S_ISDIR(mode)
+            entries.append((remote_path, is_dir))
+            if is_dir:
+                if target in ancestors:
+                    raise RuntimeError(f"Symlink loop at {remote_path}")
+                pending.append((remote_path, ancestors | {target} if target else ancestors))
+    return entries
+
+
+def _sftp_get(sftp, remote_path, local_path, progress):
+    """Pull a single file with prefetched SFTP reads and make it executable."""
+    sftp.get(remote_path, local_path,
+             callback=lambda sent, size: progress.update(remote_path, size, sent))
+    os.chmod(local_path, 0o755)
+
+
+def _sftp_get_tree(listing_sftp, root, dest, progress, skip=(), on_file=None):
+    """Pull a remote directory into dest using a pool of SFTP channels.
+
+    The tree is listed over listing_sftp before anything is pulled. Paths in skip, relative to root, are not pulled. on_file is called with the
+    local path and the path relative to root's parent for every file and
+    directory that lands.
+    """
+    parent = posixpath.dirname(root)
+    local = threading.local()
+    channels = []
+
+    def pull(remote_path, is_dir):
+        rel_path = posixpath.relpath(remote_path, parent)
+        local_path = os.path.join(dest, *rel_path.split('/'))
+        if is_dir:
+            os.makedirs(local_path, exist_ok=True)
+        else:
+            sftp = getattr(local, 'sftp', None)
+            if sftp is None:
+                sftp = local.sftp = _open_sftp()
+                channels.append(sftp)
+            os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            _sftp_get(sftp, remote_path, local_path, progress)
+        if on_file is not None:
+            on_file(local_path, rel_path)
+
+    try:
+        with ThreadPoolExecutor(max_workers=TRANSFER_WORKERS) as pool:
+            futures = [(remote_path, pool.submit(pull, remote_path, is_dir))
+                       for remote_path, is_dir in _list_remote(listing_sftp, root)
+                       if posixpath.relpath(remote_path, root) not in skip]
+            errors = []
+            for remote_path, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append(f'{remote_path}: {e}')
+    finally:
+        for sftp in channels:
+            sftp.close()
+
+    if errors:
+        raise RuntimeError(f'{len(errors)} file(s) failed to transfer:\n  ' + '\n  '.join(errors))
+
+
+def scp_transfer(sftp, src, dest, progress, skip=(), on_file=None):
+    """Transfer a remote file or directory over SFTP.
+
+    Listing and pulls go through the SFTP subsystem only, so the device needs no
+    tar, find or other shell tools beyond its sftp-server. Returns True on success. Failures are reported and flag DUMP_FAILED.
+    """
+    try:
+        tqdm.write(f"Transferring {src} to {dest} via SFTP")
+        if stat.S_ISDIR(sftp.stat(src).st_mode):
+            _sftp_get_tree(sftp, src, dest, progress, skip, on_file)
+        else:
+            local_path = os.path.join(dest, posixpath.basename(src))
+            _sftp_get(sftp, src, local_path, progress)
+            if on_file is not None:
+                on_file(local_path, posixpath.basename(src))
+        return True
+    except Exception as e:
+        tqdm.write(f"Error during SFTP transfer: {e}")
+        DUMP_FAILED.set()
+        return False
+
+
+class _Progress:
+    """Shared progress bar for all transfers, fed with per-file byte deltas."""
+
+    __slots__ = ('bar', 'last', 'names', 'lock')
+
+    def __init__(self):
+        self.bar = tqdm(unit='B', unit_scale=True, unit_divisor=1024, mininterval=0.5,
+                        disable=not sys.stdout.isatty())
+        self.last = {}
+        self.names = {}
+        self.lock = threading.Lock()
+
+    def update(self, filename, size, sent):
+        """Record that sent of size bytes of filename have been transferred."""
+        with self.lock:
+            base_name = self.names.get(filename)
+            if base_name is None:
+                base_name = os.path.basename(filename.decode('utf-8') if isinstance(filename, bytes) else filename)
+                self.names[filename] = base_name
+            last = self.last.pop(filename, None)
+            if last is None:
+                self.bar.total = (self.bar.total or 0) + size
+                last = 0
+            if sent < size:
+                self.last[filename] = sent
+            else:
+                del self.names[filename]
+            self.bar.set_description_str(base_name, refresh=False)
+            self.bar.update(sent - last)
+
+    def close(self):
+        """Close the progress bar."""
+        with self.lock:
+            self.bar.close()
 
 
 def extract_path(origin_path):
     """Extract the relative path for the dumped app."""
-    index = origin_path.find('.app/')
-    return origin_path[index + 5:]
+    head, sep, tail = origin_path.partition('.app/')
+    return tail if sep else origin_path
 
 
 def open_target_app(device, app_id):
     """Open the target app on the device."""
     print(f'Starting app {app_id}')
-    pid, session, display_name, bundle_identifier = '', None, '', ''
+    session = None
     
+    apps_by_key = {}
     for app in get_applications(device):
-        if app_id == app.identifier or app_id == app.name:
-            pid, display_name, bundle_identifier = app.pid, app.name, app.identifier
+        apps_by_key[app.identifier] = app
+        apps_by_key.setdefault(app.name, app)
+    
+    app = apps_by_key.get(app_id)
+    if app is None:
+        print(f"App {app_id} not found")
+        return session, '', ''
     
+    pid, display_name, bundle_identifier = app.pid, app.name, app.identifier
     try:
         if not pid:
             pid = device.spawn([bundle_identifier])
@@ -160,24 +351,41 @@ def open_target_app(device, app_id):
     return session, display_name, bundle_identifier
 
 
-def start_dump(session, ipa_name):
-    """Start the dumping process."""
+def start_dump(session, ipa_name, compress='store'):
+    """Start the dumping process. Returns True if the IPA was generated."""
     print(f'Dumping {ipa_name} to {TEMP_DIR}')
-    script = load_js_file(session, DUMP_JS)
-    script.post('dump')
-    FINISHED.wait()
-    generate_ipa(PAYLOAD_PATH, ipa_name)
+
+    def on_detached(reason, *args):
+        if not FINISHED.is_set():
+            tqdm.write(f"Session detached before the dump finished: {reason}")
+            DUMP_FAILED.set()
+            PACKAGE_QUEUE.put(None)
+            FINISHED.set()
+
+    session.on('detached', on_detached)
+    progress = _Progress()
+    with ThreadPoolExecutor(max_workers=1) as packager:
+        packaged = packager.submit(generate_ipa, ipa_name, compress)
+        try:
+            script = load_js_file(session, progress)
+            script.post('dump')
+            FINISHED.wait()
+        finally:
+            if not FINISHED.is_set():
+                DUMP_FAILED.set()
+                PACKAGE_QUEUE.put(None)
+            progress.close()
     if session:
         session.detach()
+    return packaged.result()
 
 
-def load_js_file(session, filename):
-    """Load and execute a JavaScript file in a Frida session."""
-    with open(filename, 'r', encoding='utf-8') as f:
-        source = f.read()
+def load_js_file(session, progress, filename=None):
+    """Load and execute dump.js, or another JavaScript file, in a Frida session."""
+    source = DUMP_JS_SOURCE if filename is None else read_js_file(filename)
     
     script = session.create_script(source)
-    script.on('message', on_message)
+    script.on('message', functools.partial(on_message, progress))
     script.load()
     return script
 
@@ -194,25 +402,44 @@ def list_applications(device):
     """List all installed applications."""
     apps = get_applications(device)
     if apps:
-        pid_width = max(len(str(app.pid)) for app in apps)
-        name_width = max(len(app.name) for app in apps)
-        id_width = max(len(app.identifier)) if apps else 0
-        print(f'{"PID":>{pid_width}}  {"Name":<{name_width}}  {"Identifier":<{id_width}}')
+        pid_width = name_width = id_width = 0
+        for app in apps:
+            pid_width = max(pid_width, len(str(app.pid)))
+            name_width = max(name_width, len(app.name))
+            id_width = max(id_width, len(app.identifier))
+        print(f'{"PID".rjust(pid_width)}  {"Name".ljust(name_width)}  {"Identifier".ljust(id_width)}')
         print(f'{"-"*pid_width}  {"-"*name_width}  {"-"*id_width}')
         for app in apps:
             pid_display = '-' if app.pid == 0 else str(app.pid)
-            print(f'{pid_display:>{pid_width}}  {app.name:<{name_width}}  {app.identifier:<{id_width}}')
+            print(f'{pid_display.rjust(pid_width)}  {app.name.ljust(name_width)}  {app.identifier.ljust(id_width)}')
     else:
         print('No applications found.')
 
 
+def prefer_fast_ciphers():
+    """Move the fastest supported SSH ciphers to the front of paramiko's preference list."""
+    preferred = paramiko.Transport._preferred_ciphers
+    fast = tuple(cipher for cipher in FAST_CIPHERS if cipher in paramiko.Transport._cipher_info)
+    paramiko.Transport._preferred_ciphers = fast + tuple(cipher for cipher in preferred if cipher not in fast)
+
+
+def remove_dirs(paths):
+    """Remove each directory tree in paths, ignoring errors."""
+    for path in paths:
+        shutil.rmtree(path, ignore_errors=True)
+
+
 def create_dir(path):
     """Create a directory if it doesn't exist, or clear it if it does."""
     path = path.rstrip('\\')
-    if os.path.exists(path):
-        shutil.rmtree(path)
     try:
-        os.makedirs(path)
+        if os.path.exists(path):
+            os.rename(path, f'{path}.gc.{os.getpid()}.{time.time_ns()}')
+        # Also sweeps trash left behind when an earlier run exited before its cleanup finished.
+        trash = glob.glob(f'{glob.escape(path)}.gc.*')
+        if trash:
+            threading.Thread(target=remove_dirs, args=(trash,), daemon=True).start()
+        os.makedirs(path, exist_ok=True)
     except os.error as err:
         print(f"Error creating directory: {err}")
 
@@ -226,6 +453,11 @@ def main():
     parser.add_argument('-u', '--user', help='SSH username')
     parser.add_argument('-P', '--password', help='SSH password')
     parser.add_argument('-K', '--key_filename', help='SSH private key file path')
+    parser.add_argument('-c', '--compress', choices=('store', 'deflate', 'zstd'), default='store',
+                        help='IPA compression: store (fastest), deflate (smaller), '
+                             'zstd (tar.zst archive, needs the zstandard package)')
+    parser.add_argument('--no-compression', action='store_true',
+                        help='Disable SSH compression (faster for apps made up mostly of media or binaries)')
     parser.add_argument('target', nargs='?', help='Bundle identifier or display name of target app')
 
     args = parser.parse_args()
@@ -234,34 +466,45 @@ def main():
         parser.print_help()
         sys.exit(1)
 
+    if args.compress == 'zstd' and zstandard is None:
+        parser.error('--compress zstd requires the zstandard package')
+
     device = get_usb_iphone()
+    exit_code = 0
 
     if args.list:
         list_applications(device)
     else:
         try:
-            global ssh
+            global ssh, sftp
             ssh = SSHClient()
             ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            prefer_fast_ciphers()
             ssh.connect(
                 hostname=args.hostname or HOSTNAME, 
                 port=int(args.port or PORT), 
                 username=args.user or USER, 
                 password=args.password or PASSWORD, 
-                key_filename=args.key_filename or KEY_FILENAME
+                key_filename=args.key_filename or KEY_FILENAME,
+                compress=not args.no_compression
             )
+            sftp = _open_sftp()
 
             create_dir(PAYLOAD_PATH)
             session, display_name, bundle_identifier = open_target_app(device, args.target)
             if session:
                 output_ipa = args.output if args.output else display_name
-                start_dump(session, output_ipa)
+                if not start_dump(session, output_ipa, args.compress):
+                    exit_code = 1
+            else:
+                exit_code = 1
         except Exception as e:
             print(f"Error: {e}")
             traceback.print_exc()
+            exit_code = 1
+        ssh.close()
 
-    FINISHED.set()
-    ssh.close()
+    sys.exit(exit_code)
 
 
 if __name__ == '__main__':